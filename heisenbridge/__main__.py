@@ -1,20 +1,22 @@
 import argparse
 import asyncio
 import base64
+import functools
 import grp
 import hashlib
 import hmac
 import logging
 import os
 import pwd
-import random
 import re
-import string
+import secrets
 import sys
 import urllib
-from fnmatch import fnmatch
+from fnmatch import translate
 from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Pattern
 from typing import Tuple
 
 from aiohttp import web
@@ -34,7 +36,7 @@ from mautrix.types import JoinRule
 from mautrix.types import Membership
 from mautrix.util.bridge_state import BridgeState
 from mautrix.util.bridge_state import BridgeStateEvent
-from mautrix.util.config import yaml
+from ruamel.yaml import YAML
 
 from heisenbridge import __version__
 from heisenbridge.appservice import AppService
@@ -50,6 +52,54 @@ from heisenbridge.room import RoomInvalidError
 from heisenbridge.space_room import SpaceRoom
 from heisenbridge.websocket import AppserviceWebsocket
 
+try:
+    # libuv based event loop for faster socket handling when installed
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# channel membership prefixes a nick may have in NAMES
+NICK_PREFIXES = frozenset("~&@%+!")
+
+# characters allowed as-is in puppet localparts, everything else is escaped as =xx
+MXID_ALLOWED = frozenset("0123456789abcdefghijklmnopqrstuvwxyz-.=_/")
+MXID_ESCAPE_TABLE = {c: f"={c:02x}" for c in range(128) if chr(c) not in MXID_ALLOWED}
+MXID_ESCAPE_RE = re.compile(r"[^0-9a-z\-\.=\_/]")
+MXID_UNESCAPE_RE = re.compile(r"=([0-9a-z]{2})")
+
+# the safe loader and dumper use the libyaml C extension when available
+registration_yaml = YAML(typ="safe")
+# dump in block style and in insertion order like the round-trip dumper does
+registration_yaml.default_flow_style = False
+registration_yaml.sort_base_mapping_type_on_output = False
+
+# room types and their init order, network must be before chat and group
+ROOM_TYPES = (HiddenRoom, ControlRoom, NetworkRoom, PrivateRoom, ChannelRoom, PlumbedRoom, SpaceRoom)
+ROOM_TYPE_MAP = {room_type.__name__: room_type for room_type in ROOM_TYPES}
+
+
+def escape_mxid(localpart: str) -> str:
+    if MXID_ALLOWED.issuperset(localpart):
+        return localpart
+
+    if localpart.isascii():
+        return localpart.translate(MXID_ESCAPE_TABLE)
+
+    return MXID_ESCAPE_RE.sub(lambda m: "=" + m.group(0).encode("utf-8").hex(), localpart)
+
+
+def split_mxid(mxid: str) -> Tuple[str, str]:
+    # the server part may include a port so split on the first colon
+    (name, _, server) = mxid.partition(":")
+    return name, server
+
+
+def unescape_mxid(localpart: str) -> str:
+    if "=" not in localpart:
+        return localpart
+
+    return MXID_UNESCAPE_RE.sub(lambda m: bytes.fromhex(m.group(1)).decode("utf-8"), localpart)
+
 
 class MemoryBridgeStateStore(ASStateStore, MemoryStateStore):
     def __init__(self) -> None:
@@ -61,9 +111,19 @@ class BridgeAppService(AppService):
     az: MauService
     _api: HTTPAPI
     _rooms: Dict[str, Room]
+    _rooms_by_type: Dict[str, Dict[str, Dict[str, Room]]]
+    _rooms_by_user: Dict[str, Dict[str, Room]]
+    _network_rooms: Dict[Tuple[str, str], Dict[str, NetworkRoom]]
     _users: Dict[str, str]
+    _irc_user_ids: Dict[Tuple[str, str], str]
+    _registering: Dict[str, asyncio.Future]
+    _admin_re: Optional[Pattern] = None
+    _user_re: Optional[Pattern] = None
+    _allow_exact: Dict[str, str]
+    media_endpoint: Optional[str] = None
 
     DEFAULT_MEDIA_PATH = "/_heisenbridge/media/{server}/{media_id}/{checksum}{filename}"
+    IRC_USER_ID_CACHE_SIZE = 65536
 
     async def push_bridge_state(
         self,
@@ -84,62 +144,126 @@ class BridgeAppService(AppService):
             remote_id=remote_id,
         )
 
-        logging.debug(f"Updating bridge state {state}")
+        logging.debug("Updating bridge state %s", state)
 
         await state.send(self.registration["heisenbridge"]["status_endpoint"], self.az.as_token, log=logging)
 
     def register_room(self, room: Room):
+        # re-registering replaces the previous instance in all indexes
+        self.unregister_room(room.id)
+
         self._rooms[room.id] = room
+        self._rooms_by_type.setdefault(type(room).__name__, {}).setdefault(room.user_id, {})[room.id] = room
+        self._rooms_by_user.setdefault(room.user_id, {})[room.id] = room
+
+        # network names are set before registering and never change afterwards
+        if type(room) is NetworkRoom:
+            self._network_rooms.setdefault((room.user_id, room.name.lower()), {})[room.id] = room
 
     def unregister_room(self, room_id):
-        if room_id in self._rooms:
-            del self._rooms[room_id]
+        room = self._rooms.pop(room_id, None)
+        if room is None:
+            return
 
-    # this is mostly used by network rooms at init, it's a bit slow
-    def find_rooms(self, rtype=None, user_id=None) -> List[Room]:
-        ret = []
+        rtype = type(room).__name__
+        by_type = self._rooms_by_type.get(rtype, {})
+        indexes = [(by_type, room.user_id), (self._rooms_by_user, room.user_id)]
+
+        if type(room) is NetworkRoom:
+            indexes.append((self._network_rooms, (room.user_id, room.name.lower())))
 
-        if rtype is not None and type(rtype) != str:
+        for index, key in indexes:
+            rooms = index.get(key)
+            if rooms is not None:
+                rooms.pop(room_id, None)
+                if len(rooms) == 0:
+                    del index[key]
+
+        if len(by_type) == 0:
+            self._rooms_by_type.pop(rtype, None)
+
+    # rooms are indexed by type name and user_id so lookups only touch matching rooms
+    def find_rooms(self, rtype=None, user_id=None) -> List[Room]:
+        if rtype is not None and not isinstance(rtype, str):
             rtype = rtype.__name__
 
-        for room in self._rooms.values():
-            if (rtype is None or room.__class__.__name__ == rtype) and (user_id is None or room.user_id == user_id):
-                ret.append(room)
+        if rtype is None:
+            if user_id is None:
+                return list(self._rooms.values())
 
-        return ret
+            return list(self._rooms_by_user.get(user_id, {}).values())
+
+        by_type = self._rooms_by_type.get(rtype, {})
+
+        if user_id is None:
+            return [room for rooms in by_type.values() for room in rooms.values()]
+
+        return list(by_type.get(user_id, {}).values())
+
+    async def load(self):
+        await super().load()
+        self._compile_allow()
+
+    async def save(self):
+        # allow masks are only changed before saving
+        self._compile_allow()
+        await super().save()
+
+    def _compile_allow(self):
+        def union(masks):
+            masks = list(masks)
+            return re.compile("|".join(translate(mask) for mask in masks)) if masks else None
+
+        # masks without wildcards are plain user ids and can be looked up directly
+        self._allow_exact = {}
+        globs = {}
+        for mask, value in self.config.get("allow", {}).items():
+            if "*" in mask or "?" in mask or "[" in mask:
+                globs[mask] = value
+            else:
+                self._allow_exact[mask] = value
+
+        self._admin_re = union(mask for mask, value in globs.items() if value == "admin")
+        self._user_re = union(globs)
 
     def is_admin(self, user_id: str):
-        if user_id == self.config["owner"]:
+        if user_id == self.config["owner"] or self._allow_exact.get(user_id) == "admin":
             return True
 
-        for mask, value in self.config["allow"].items():
-            if fnmatch(user_id, mask) and value == "admin":
-                return True
-
-        return False
+        return self._admin_re is not None and self._admin_re.match(user_id) is not None
 
     def is_user(self, user_id: str):
-        if self.is_admin(user_id):
+        if user_id == self.config["owner"] or user_id in self._allow_exact:
             return True
 
-        for mask in self.config["allow"].keys():
-            if fnmatch(user_id, mask):
-                return True
+        # any matching mask is enough, admin masks included
+        return self._user_re is not None and self._user_re.match(user_id) is not None
+
+    def _set_namespace(self, server_name: str, puppet_prefix: Optional[str] = None):
+        # mxid checks run for every event, keep the affixes precomputed
+        self.server_name = sys.intern(server_name)
+        self._server_suffix = ":" + self.server_name
 
-        return False
+        if puppet_prefix is not None:
+            self.puppet_prefix = puppet_prefix
+            self._puppet_prefix_at = "@" + self.puppet_prefix
 
     def is_local(self, mxid: str):
-        return mxid.endswith(":" + self.server_name)
+        return mxid.endswith(self._server_suffix)
+
+    def is_puppet(self, mxid: str):
+        return mxid.startswith(self._puppet_prefix_at) and mxid.endswith(self._server_suffix)
 
     def strip_nick(self, nick: str) -> Tuple[str, str]:
-        m = re.match(r"^([~&@%\+!]?)(.+)$", nick)
-        if m:
-            return (m.group(2), (m.group(1) if len(m.group(1)) > 0 else None))
+        if len(nick) > 1 and nick[0] in NICK_PREFIXES:
+            return (nick[1:], nick[0])
+        elif len(nick) > 0:
+            return (nick, None)
         else:
             raise TypeError(f"Input nick is not valid: '{nick}'")
 
     def split_irc_user_id(self, user_id):
-        (name, server) = user_id.split(":", 1)
+        (name, server) = split_mxid(user_id)
 
         network = None
         nick = None
@@ -147,78 +271,98 @@ class BridgeAppService(AppService):
         if server != self.server_name:
             return None, None
 
-        if not name.startswith("@" + self.puppet_prefix):
+        if not name.startswith(self._puppet_prefix_at):
             return None, None
 
         network_nick = name[len(self.puppet_prefix) + 1 :]
 
-        m = re.match(r"([^" + self.puppet_separator + r"]+).(.+)$", network_nick)
+        (network_part, _, nick_part) = network_nick.partition(self.puppet_separator)
 
-        if m:
-            network = re.sub(r"=([0-9a-z]{2})", lambda m: bytes.fromhex(m.group(1)).decode("utf-8"), m.group(1)).lower()
-            nick = re.sub(r"=([0-9a-z]{2})", lambda m: bytes.fromhex(m.group(1)).decode("utf-8"), m.group(2)).lower()
+        if network_part and nick_part:
+            network = unescape_mxid(network_part).lower()
+            nick = unescape_mxid(nick_part).lower()
 
         return network, nick
 
     def nick_from_irc_user_id(self, network, user_id):
-        (name, server) = user_id.split(":", 1)
+        (name, server) = split_mxid(user_id)
 
         if server != self.server_name:
             return None
 
-        prefix = "@" + re.sub(
-            r"[^0-9a-z\-\.=\_/]",
-            lambda m: "=" + m.group(0).encode("utf-8").hex(),
-            f"{self.puppet_prefix}{network}{self.puppet_separator}".lower(),
-        )
+        prefix = "@" + escape_mxid(f"{self.puppet_prefix}{network}{self.puppet_separator}".lower())
 
         if not name.startswith(prefix):
             return None
 
         nick = name[len(prefix) :]
-        nick = re.sub(r"=([0-9a-z]{2})", lambda m: bytes.fromhex(m.group(1)).decode("utf-8"), nick)
+        nick = unescape_mxid(nick)
 
         return nick
 
     def irc_user_id(self, network, nick, at=True, server=True):
-        nick, mode = self.strip_nick(nick)
+        # cache holds the full mxid, other forms are sliced from it
+        ret = self._irc_user_ids.get((network, nick))
 
-        ret = re.sub(
-            r"[^0-9a-z\-\.=\_/]",
-            lambda m: "=" + m.group(0).encode("utf-8").hex(),
-            f"{self.puppet_prefix}{network}{self.puppet_separator}{nick}".lower(),
-        )
+        if ret is None:
+            stripped, _ = self.strip_nick(nick)
+
+            ret = escape_mxid(f"{self.puppet_prefix}{network}{self.puppet_separator}{stripped}".lower())
+            # puppet ids are compared and hashed all the time, keep a single copy of each
+            ret = sys.intern("@" + ret + self._server_suffix)
 
-        if at:
-            ret = "@" + ret
+            # evict the oldest entry when full
+            if len(self._irc_user_ids) >= self.IRC_USER_ID_CACHE_SIZE:
+                del self._irc_user_ids[next(iter(self._irc_user_ids))]
 
-        if server:
-            ret += ":" + self.server_name
+            self._irc_user_ids[(network, nick)] = ret
+
+        if not at:
+            ret = ret[1:]
+
+        if not server:
+            ret = ret[: -len(self._server_suffix)]
 
         return ret
 
     async def cache_user(self, user_id, displayname):
         # start by caching that the user_id exists without a displayname
-        if user_id not in self._users:
-            self._users[user_id] = None
+        current = self._users.setdefault(user_id, None)
 
         # if the cached displayname is incorrect
-        if displayname and self._users[user_id] != displayname:
+        if displayname and current != displayname:
             try:
                 await self.az.intent.user(user_id).set_displayname(displayname)
                 self._users[user_id] = displayname
             except MatrixRequestError as e:
-                logging.warning(f"Failed to set displayname '{displayname}' for user_id '{user_id}', got '{e}'")
+                logging.warning("Failed to set displayname '%s' for user_id '%s', got '%s'", displayname, user_id, e)
 
     def is_user_cached(self, user_id, displayname=None):
-        return user_id in self._users and (displayname is None or self._users[user_id] == displayname)
+        if displayname is None:
+            return user_id in self._users
+
+        # a cached None never equals a displayname so a single lookup is enough
+        return self._users.get(user_id) == displayname
+
+    def try_irc_user_id(self, network, nick):
+        user_id = self.irc_user_id(network, nick)
+
+        # fully cached puppets need no registration or displayname update
+        return user_id if self.is_user_cached(user_id, nick) else None
 
     async def ensure_irc_user_id(self, network, nick, update_cache=True):
         user_id = self.irc_user_id(network, nick)
 
         # if we've seen this user before, we can skip registering
         if not self.is_user_cached(user_id):
-            await self.az.intent.user(self.irc_user_id(network, nick)).ensure_registered()
+            # rooms on the same network race to register the same puppets, share a pending registration
+            registering = self._registering.get(user_id)
+            if registering is None:
+                registering = asyncio.ensure_future(self.az.intent.user(user_id).ensure_registered())
+                registering.add_done_callback(lambda _: self._registering.pop(user_id, None))
+                self._registering[user_id] = registering
+
+            await asyncio.shield(registering)
 
         # always ensure the displayname is up-to-date
         if update_cache:
@@ -227,114 +371,145 @@ class BridgeAppService(AppService):
         return user_id
 
     async def _on_mx_event(self, event):
-        if event.room_id and event.room_id in self._rooms:
+        room = self._rooms.get(event.room_id) if event.room_id else None
+        is_member = event.type == EventType.ROOM_MEMBER
+
+        if room is not None:
             try:
-                room = self._rooms[event.room_id]
-                await room.on_mx_event(event)
+                # membership changes are applied in order, other handlers may run for a long time (CONNECT)
+                if is_member:
+                    async with room.lock:
+                        await room.on_mx_event(event)
+                else:
+                    await room.on_mx_event(event)
             except RoomInvalidError:
-                logging.info(f"Event handler for {event.type} threw RoomInvalidError, leaving and cleaning up.")
+                logging.info("Event handler for %s threw RoomInvalidError, leaving and cleaning up.", event.type)
                 self.unregister_room(room.id)
                 room.cleanup()
 
                 await self.leave_room(room.id, room.members)
             except Exception:
                 logging.exception("Ignoring exception from room handler. This should be fixed.")
-        elif (
-            str(event.type) == "m.room.member"
-            and event.sender != self.user_id
-            and event.content.membership == Membership.INVITE
-        ):
-            # set owner if we have none and the user is from the same HS
-            if self.config.get("owner", None) is None and event.sender.endswith(":" + self.server_name):
-                logging.info(f"We have an owner now, let us rejoice, {event.sender}!")
-                self.config["owner"] = event.sender
-                await self.save()
-
-            if not self.is_user(event.sender):
-                logging.info(f"Non-whitelisted user {event.sender} tried to invite us, ignoring.")
-                return
-            else:
-                logging.info(f"Got an invite from {event.sender}")
 
-            if not event.content.is_direct:
-                logging.debug("Got an invite to non-direct room, ignoring")
-                return
+            return
 
-            # only respond to invites unknown new rooms
-            if event.room_id in self._rooms:
-                logging.debug("Got an invite to room we're already in, ignoring")
-                return
+        # everything else we care about is an invite from someone else to an unknown room
+        if not is_member or event.sender == self.user_id or event.content.membership != Membership.INVITE:
+            return
 
-            # handle invites against puppets
-            if event.state_key != self.user_id:
-                logging.info(f"Whitelisted user {event.sender} invited {event.state_key}, going to reject.")
+        # set owner if we have none and the user is from the same HS
+        if self.config.get("owner", None) is None and self.is_local(event.sender):
+            logging.info("We have an owner now, let us rejoice, %s!", event.sender)
+            self.config["owner"] = event.sender
+            await self.save()
 
-                try:
-                    await self.az.intent.user(event.state_key).kick_user(
-                        event.room_id,
-                        event.state_key,
-                        "Will invite YOU instead",
+        if not self.is_user(event.sender):
+            logging.info("Non-whitelisted user %s tried to invite us, ignoring.", event.sender)
+            return
+        else:
+            logging.info("Got an invite from %s", event.sender)
+
+        if not event.content.is_direct:
+            logging.debug("Got an invite to non-direct room, ignoring")
+            return
+
+        # only respond to invites unknown new rooms, it may have been registered while we were saving
+        if event.room_id in self._rooms:
+            logging.debug("Got an invite to room we're already in, ignoring")
+            return
+
+        # handle invites against puppets
+        if event.state_key != self.user_id:
+            logging.info("Whitelisted user %s invited %s, going to reject.", event.sender, event.state_key)
+
+            try:
+                await self.az.intent.user(event.state_key).kick_user(
+                    event.room_id,
+                    event.state_key,
+                    "Will invite YOU instead",
+                )
+            except Exception:
+                logging.exception("Failed to reject invitation.")
+
+            (network, nick) = self.split_irc_user_id(event.state_key)
+
+            if network is not None and nick is not None:
+                # network is already lowercased, use the first matching network room
+                for room in self._network_rooms.get((event.sender, network), {}).values():
+                    logging.debug(
+                        "Found matching network room (%s) for %s, emulating query command for %s",
+                        network,
+                        event.sender,
+                        nick,
                     )
-                except Exception:
-                    logging.exception("Failed to reject invitation.")
+                    await room.cmd_query(argparse.Namespace(nick=nick, message=[]))
+                    break
 
-                (network, nick) = self.split_irc_user_id(event.state_key)
+            return
 
-                if network is not None and nick is not None:
-                    for room in self.find_rooms(NetworkRoom, event.sender):
-                        if room.name.lower() == network.lower():
-                            logging.debug(
-                                "Found matching network room ({network}) for {event.sender}, emulating query command for {nick}"
-                            )
-                            await room.cmd_query(argparse.Namespace(nick=nick, message=[]))
-                            break
+        logging.info("Whitelisted user %s invited us, going to accept.", event.sender)
 
-                return
+        # accept invite sequence
+        joined = False
+        try:
+            room = ControlRoom(id=event.room_id, user_id=event.sender, serv=self, members=[event.sender], bans=[])
+            self.register_room(room)
 
-            logging.info(f"Whitelisted user {event.sender} invited us, going to accept.")
+            # saving the room state and joining are independent of each other
+            results = await asyncio.gather(room.save(), self.az.intent.join_room(room.id), return_exceptions=True)
+            joined = not isinstance(results[1], Exception)
 
-            # accept invite sequence
-            try:
-                room = ControlRoom(id=event.room_id, user_id=event.sender, serv=self, members=[event.sender], bans=[])
-                await room.save()
-                self.register_room(room)
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
 
-                await self.az.intent.join_room(room.id)
+            # show help on open
+            await room.show_help()
+        except Exception:
+            self.unregister_room(event.room_id)
+            logging.exception("Failed to create control room.")
 
-                # show help on open
-                await room.show_help()
-            except Exception:
-                if event.room_id in self._rooms:
-                    del self._rooms[event.room_id]
-                logging.exception("Failed to create control room.")
-        else:
-            pass
-            # print(json.dumps(event, indent=4, sort_keys=True))
+            # nothing handles the room anymore, do not stay in it
+            if joined:
+                try:
+                    await self.leave_room(event.room_id, None)
+                except Exception:
+                    logging.exception("Failed to leave control room.")
 
     async def detect_public_endpoint(self):
-        async with self.api.session as session:
-            # first try https well-known
-            try:
-                resp = await session.request(
-                    "GET",
-                    "https://{}/.well-known/matrix/client".format(self.server_name),
-                )
+        # the session is shared with the api, it must not be closed here
+        session = self.api.session
+
+        async def well_known():
+            async with session.get("https://{}/.well-known/matrix/client".format(self.server_name)) as resp:
                 data = await resp.json(content_type=None)
                 return data["m.homeserver"]["base_url"]
-            except Exception:
-                logging.debug("Did not find .well-known for HS")
 
-            # try https directly
-            try:
-                resp = await session.request("GET", "https://{}/_matrix/client/versions".format(self.server_name))
+        async def direct():
+            async with session.get("https://{}/_matrix/client/versions".format(self.server_name)) as resp:
                 await resp.json(content_type=None)
                 return "https://{}".format(self.server_name)
-            except Exception:
-                logging.debug("Could not use direct connection to HS")
 
-            # give up
-            logging.warning("Using internal URL for homeserver, media links are likely broken!")
-            return str(self.api.base_url)
+        # probe directly in the background while waiting for the preferred well-known
+        direct_task = asyncio.ensure_future(direct())
+
+        # first try https well-known
+        try:
+            endpoint = await well_known()
+            direct_task.cancel()
+            return endpoint
+        except Exception:
+            logging.debug("Did not find .well-known for HS")
+
+        # try https directly
+        try:
+            return await direct_task
+        except Exception:
+            logging.debug("Could not use direct connection to HS")
+
+        # give up
+        logging.warning("Using internal URL for homeserver, media links are likely broken!")
+        return str(self.api.base_url)
 
     def mxc_checksum(self, server: str, media_id: str) -> str:
         checksum_raw = hmac.new(self.media_key, f"mxc://{server}/{media_id}/".encode("utf-8"), hashlib.sha256).digest()
@@ -402,14 +577,15 @@ class BridgeAppService(AppService):
 
     async def reset(self, config_file, homeserver_url):
         with open(config_file) as f:
-            registration = yaml.load(f)
+            registration = registration_yaml.load(f)
 
         api = HTTPAPI(base_url=homeserver_url, token=registration["as_token"])
         whoami = await api.request(Method.GET, Path.v3.account.whoami)
         self.user_id = whoami["user_id"]
-        self.server_name = self.user_id.split(":", 1)[1]
         print("We are " + whoami["user_id"])
 
+        self._set_namespace(split_mxid(self.user_id)[1])
+
         self.az = MauService(
             id=registration["id"],
             domain=self.server_name,
@@ -429,9 +605,14 @@ class BridgeAppService(AppService):
         joined_rooms = await self.az.intent.get_joined_rooms()
         print(f"Leaving from {len(joined_rooms)} rooms...")
 
-        for room_id in joined_rooms:
-            print(f"Leaving from {room_id}...")
-            await self.leave_room(room_id, None)
+        leave_limit = asyncio.Semaphore(8)
+
+        async def leave_room(room_id):
+            async with leave_limit:
+                print(f"Leaving from {room_id}...")
+                await self.leave_room(room_id, None)
+
+        await asyncio.gather(*[leave_room(room_id) for room_id in joined_rooms])
 
         print("Resetting configuration...")
         self.config = {}
@@ -441,19 +622,20 @@ class BridgeAppService(AppService):
 
     def load_reg(self, config_file):
         with open(config_file) as f:
-            self.registration = yaml.load(f)
+            self.registration = registration_yaml.load(f)
 
     async def leave_room(self, room_id, members):
         members = members if members else []
 
-        for member in members:
-            (name, server) = member.split(":", 1)
+        # puppets leave independently of each other
+        results = await asyncio.gather(
+            *[self.az.intent.user(member).leave_room(room_id) for member in members if self.is_puppet(member)],
+            return_exceptions=True,
+        )
 
-            if name.startswith("@" + self.puppet_prefix) and server == self.server_name:
-                try:
-                    await self.az.intent.user(member).leave_room(room_id)
-                except Exception:
-                    logging.exception("Removing puppet on leave failed")
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error("Removing puppet on leave failed", exc_info=result)
 
         try:
             await self.az.intent.leave_room(room_id)
@@ -464,15 +646,15 @@ class BridgeAppService(AppService):
         except MatrixRequestError:
             pass
 
-    def _keepalive(self):
-        async def put_presence():
+    async def _presence_loop(self):
+        # a single task, an update never overlaps the previous one
+        while True:
             try:
                 await self.az.intent.set_presence(self.user_id)
             except Exception:
-                pass
+                logging.debug("Failed to update presence", exc_info=True)
 
-        asyncio.ensure_future(put_presence())
-        asyncio.get_running_loop().call_later(60, self._keepalive)
+            await asyncio.sleep(60)
 
     async def ensure_hidden_room(self):
         use_hidden_room = self.config.get("use_hidden_room", False)
@@ -544,7 +726,12 @@ class BridgeAppService(AppService):
         if media_proxy:
             print("Media proxy only mode.", flush=True)
 
+        # parsed once here, fail before any connection attempts if it is unusable
         url = urllib.parse.urlparse(homeserver_url)
+        if url.scheme not in ["http", "https", "ws", "wss"] or not url.netloc:
+            print(f"Invalid homeserver URL: {homeserver_url}")
+            sys.exit(1)
+
         ws = None
         if url.scheme in ["ws", "wss"]:
             print(
@@ -576,7 +763,7 @@ class BridgeAppService(AppService):
             except MatrixConnectionError as e:
                 if wait < 30:
                     wait += 5
-                logging.warning(f"Failed to connect to HS: {e}, retrying in {wait} seconds...")
+                logging.warning("Failed to connect to HS: %s, retrying in %d seconds...", e, wait)
                 await asyncio.sleep(wait)
             except Exception:
                 logging.exception("Unexpected failure when registering appservice user.")
@@ -585,10 +772,10 @@ class BridgeAppService(AppService):
         # mautrix migration requires us to call whoami manually at this point
         whoami = await self.api.request(Method.GET, Path.v3.account.whoami)
 
-        logging.info("We are " + whoami["user_id"])
+        logging.info("We are %s", whoami["user_id"])
 
         self.user_id = whoami["user_id"]
-        self.server_name = self.user_id.split(":", 1)[1]
+        self._set_namespace(split_mxid(self.user_id)[1], self.puppet_prefix)
 
         self.az = MauService(
             id=self.registration["id"],
@@ -619,14 +806,20 @@ class BridgeAppService(AppService):
         if "heisenbridge" in self.registration and "displayname" in self.registration["heisenbridge"]:
             try:
                 logging.debug(
-                    f"Overriding displayname from registration file to {self.registration['heisenbridge']['displayname']}"
+                    "Overriding displayname from registration file to %s",
+                    self.registration["heisenbridge"]["displayname"],
                 )
                 await self.az.intent.set_displayname(self.registration["heisenbridge"]["displayname"])
             except MatrixRequestError as e:
-                logging.warning(f"Failed to set displayname: {str(e)}")
+                logging.warning("Failed to set displayname: %s", e)
 
         self._rooms = {}
+        self._rooms_by_type = {}
+        self._rooms_by_user = {}
+        self._network_rooms = {}
         self._users = {}
+        self._irc_user_ids = {}
+        self._registering = {}
         self.config = {
             "networks": {},
             "owner": None,
@@ -641,14 +834,15 @@ class BridgeAppService(AppService):
             "media_key": None,
             "namespace": self.puppet_prefix,
         }
-        logging.debug(f"Default config: {self.config}")
+        logging.debug("Default config: %s", self.config)
+        self._compile_allow()
         self.synapse_admin = False
 
         try:
             is_admin = await self.api.request(Method.GET, SynapseAdminPath.v1.users[self.user_id].admin)
             self.synapse_admin = is_admin["admin"]
         except MForbidden:
-            logging.info(f"We ({self.user_id}) are not a server admin, inviting puppets is required.")
+            logging.info("We (%s) are not a server admin, inviting puppets is required.", self.user_id)
         except Exception:
             logging.info("Seems we are not connected to Synapse, inviting puppets is required.")
 
@@ -665,7 +859,7 @@ class BridgeAppService(AppService):
         # use configured media_url for endpoint if we have it
         if "heisenbridge" in self.registration and "media_url" in self.registration["heisenbridge"]:
             logging.debug(
-                f"Overriding media URL from registration file to {self.registration['heisenbridge']['media_url']}"
+                "Overriding media URL from registration file to %s", self.registration["heisenbridge"]["media_url"]
             )
             self.media_endpoint = self.registration["heisenbridge"]["media_url"]
         elif self.config["media_url"]:
@@ -674,7 +868,7 @@ class BridgeAppService(AppService):
         # use configured media_path for media_path if we have it
         if "heisenbridge" in self.registration and "media_path" in self.registration["heisenbridge"]:
             logging.debug(
-                f"Overriding media path from registration file to {self.registration['heisenbridge']['media_path']}"
+                "Overriding media path from registration file to %s", self.registration["heisenbridge"]["media_path"]
             )
             self.media_path = self.registration["heisenbridge"]["media_path"]
         elif self.config["media_path"]:
@@ -688,7 +882,7 @@ class BridgeAppService(AppService):
             return
 
         logging.info("Starting presence loop")
-        self._keepalive()
+        self._presence_task = asyncio.ensure_future(self._presence_loop())
 
         # do a little migration for servers, remove this later
         for network in self.config["networks"].values():
@@ -702,18 +896,20 @@ class BridgeAppService(AppService):
                 logging.debug("Migrating servers from old to new config format")
                 network["servers"] = new_servers
 
-        logging.debug(f"Merged configuration from HS: {self.config}")
+        logging.debug("Merged configuration from HS: %s", self.config)
 
         # prevent starting bridge with changed namespace
         if self.config["namespace"] != self.puppet_prefix:
             logging.error(
-                f"Previously used namespace '{self.config['namespace']}' does not match current '{self.puppet_prefix}'."
+                "Previously used namespace '%s' does not match current '%s'.",
+                self.config["namespace"],
+                self.puppet_prefix,
             )
             sys.exit(1)
 
         # honor command line owner
         if owner is not None and self.config["owner"] != owner:
-            logging.info(f"Overriding loaded owner with '{owner}'")
+            logging.info("Overriding loaded owner with '%s'", owner)
             self.config["owner"] = owner
 
         # always ensure our merged and migrated configuration is up-to-date
@@ -722,114 +918,136 @@ class BridgeAppService(AppService):
         print("Fetching joined rooms...", flush=True)
 
         joined_rooms = await self.az.intent.get_joined_rooms()
-        logging.debug(f"Appservice rooms: {joined_rooms}")
+        logging.debug("Appservice rooms: %s", joined_rooms)
 
         print(f"Bridge is in {len(joined_rooms)} rooms, initializing them...", flush=True)
 
         Room.init_class(self.az)
         self.hidden_room = None
 
-        # room types and their init order, network must be before chat and group
-        room_types = [HiddenRoom, ControlRoom, NetworkRoom, PrivateRoom, ChannelRoom, PlumbedRoom, SpaceRoom]
-
-        room_type_map = {}
-        for room_type in room_types:
+        for room_type in ROOM_TYPES:
             room_type.init_class(self.az)
-            room_type_map[room_type.__name__] = room_type
 
         # we always auto-open control room for owner
         owner_control_open = False
 
-        # import all rooms
-        for room_id in joined_rooms:
+        # limit concurrent homeserver requests while importing rooms
+        import_limit = asyncio.Semaphore(16)
+
+        async def drop_room(room_id, joined):
+            # regardless of same mode, we ignore this room
+            self.unregister_room(room_id)
+
+            if safe_mode:
+                print("Safe mode enabled, not leaving room.", flush=True)
+            else:
+                await self.leave_room(room_id, joined.keys())
+
+        async def import_room(room_id):
             joined = {}
 
-            try:
-                config = await self.az.intent.get_account_data("irc", room_id)
+            async with import_limit:
+                try:
+                    # nearly every joined room is ours, fetch config, members state and join rules in one go
+                    (config, _, join_rules) = await asyncio.gather(
+                        self.az.intent.get_account_data("irc", room_id),
+                        self.az.intent.get_room_members(room_id),
+                        self.az.intent.get_state_event(room_id, EventType.ROOM_JOIN_RULES),
+                    )
 
-                if "type" not in config or "user_id" not in config:
-                    raise Exception("Invalid config")
+                    if "type" not in config or "user_id" not in config:
+                        raise Exception("Invalid config")
 
-                cls = room_type_map.get(config["type"])
-                if not cls:
-                    raise Exception("Unknown room type")
+                    cls = ROOM_TYPE_MAP.get(config["type"])
+                    if not cls:
+                        raise Exception("Unknown room type")
 
-                # refresh room members state
-                await self.az.intent.get_room_members(room_id)
+                    joined = await self.az.state_store.get_member_profiles(room_id, (Membership.JOIN,))
+                    banned = await self.az.state_store.get_members(room_id, (Membership.BAN,))
 
-                joined = await self.az.state_store.get_member_profiles(room_id, (Membership.JOIN,))
-                banned = await self.az.state_store.get_members(room_id, (Membership.BAN,))
+                    room = cls(id=room_id, user_id=config["user_id"], serv=self, members=joined.keys(), bans=banned)
+                    room.from_config(config)
 
-                room = cls(id=room_id, user_id=config["user_id"], serv=self, members=joined.keys(), bans=banned)
-                room.from_config(config)
+                    if join_rules.join_rule == JoinRule.RESTRICTED and join_rules.allow:
+                        room.hidden_room_id = join_rules.allow[0].room_id
 
-                join_rules = await self.az.intent.get_state_event(room_id, EventType.ROOM_JOIN_RULES)
-                if join_rules.join_rule == JoinRule.RESTRICTED and join_rules.allow:
-                    room.hidden_room_id = join_rules.allow[0].room_id
+                    # add to room displayname
+                    room.displaynames.update(
+                        {
+                            user_id: member.displayname
+                            for user_id, member in joined.items()
+                            if member.displayname is not None
+                        }
+                    )
 
-                # add to room displayname
-                for user_id, member in joined.items():
-                    if member.displayname is not None:
-                        room.displaynames[user_id] = member.displayname
-                    # add to global puppet cache if it's a puppet
-                    if user_id.startswith("@" + self.puppet_prefix) and self.is_local(user_id):
-                        self._users[user_id] = member.displayname
+                    return room, joined
+                except Exception:
+                    logging.exception("Failed to reconfigure room %s during init, leaving.", room_id)
+                    await drop_room(room_id, joined)
+                    return None
 
-                # only add valid rooms to event handler
-                if room.is_valid():
-                    self._rooms[room_id] = room
-                else:
-                    room.cleanup()
-                    raise Exception("Room validation failed after init")
+        # import all rooms concurrently but register them in the order we got them
+        for imported in await asyncio.gather(*[import_room(room_id) for room_id in joined_rooms]):
+            if imported is None:
+                continue
 
-                if cls is HiddenRoom:
-                    self.hidden_room = room
+            room, joined = imported
 
-                if cls == ControlRoom and room.user_id == self.config["owner"]:
-                    owner_control_open = True
-            except Exception:
-                logging.exception(f"Failed to reconfigure room {room_id} during init, leaving.")
+            # only add valid rooms to event handler, validity can depend on rooms registered before this one
+            if not room.is_valid():
+                room.cleanup()
+                logging.error("Room %s failed validation after init, leaving.", room.id)
+                await drop_room(room.id, joined)
+                continue
 
-                # regardless of same mode, we ignore this room
-                self.unregister_room(room_id)
+            # add all puppets to global puppet cache at once
+            self._users.update(
+                {user_id: member.displayname for user_id, member in joined.items() if self.is_puppet(user_id)}
+            )
 
-                if safe_mode:
-                    print("Safe mode enabled, not leaving room.", flush=True)
-                else:
-                    await self.leave_room(room_id, joined.keys())
+            self.register_room(room)
+
+            if type(room) is HiddenRoom:
+                self.hidden_room = room
+
+            if type(room) is ControlRoom and room.user_id == self.config["owner"]:
+                owner_control_open = True
 
         try:
             await self.ensure_hidden_room()
         except Exception as e:
-            logging.debug(f"Failed setting up hidden room: {e}")
+            logging.debug("Failed setting up hidden room: %s", e)
 
         print("All valid rooms initialized, connecting network rooms...", flush=True)
 
-        wait = 1
-        for room in list(self._rooms.values()):
+        # post init may unregister other rooms, skip the ones that are gone
+        for room_id in list(self._rooms):
+            room = self._rooms.get(room_id)
+            if room is None:
+                continue
+
             await room.post_init()
 
             # check again if we're still valid
             if not room.is_valid():
-                logging.debug(f"Room {room.id} failed validation after post init, leaving.")
+                logging.debug("Room %s failed validation after post init, leaving.", room.id)
 
                 self.unregister_room(room.id)
 
                 if not safe_mode:
                     await self.leave_room(room.id, room.members)
 
-                continue
-
-            # connect network rooms one by one, this may take a while
-            if type(room) == NetworkRoom and room.connected:
+        # connect network rooms one by one, this may take a while
+        network_rooms = [room for room in self.find_rooms(NetworkRoom) if room.connected]
 
-                def sync_connect(room):
-                    asyncio.ensure_future(room.connect())
+        async def connect_networks():
+            for room in network_rooms:
+                await asyncio.sleep(1)
+                asyncio.ensure_future(room.connect())
 
-                asyncio.get_running_loop().call_later(wait, sync_connect, room)
-                wait += 1
+        self._connect_task = asyncio.ensure_future(connect_networks())
 
-        print(f"Init done with {wait-1} networks connecting, bridge is now running!", flush=True)
+        print(f"Init done with {len(network_rooms)} networks connecting, bridge is now running!", flush=True)
 
         await self.push_bridge_state(BridgeStateEvent.UNCONFIGURED)
 
@@ -855,12 +1073,13 @@ class BridgeAppService(AppService):
                 # show help on open
                 await room.show_help()
             except Exception:
-                print("Failed to create control room, huh")
+                logging.exception("Failed to create control room, huh")
 
         await asyncio.Event().wait()
 
 
-async def async_main():
+@functools.lru_cache(maxsize=1)
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         prog=os.path.basename(sys.executable) + " -m " + __package__,
         description=f"a bouncer-style Matrix IRC bridge (v{__version__})",
@@ -938,24 +1157,33 @@ async def async_main():
         default="http://localhost:8008",
     )
 
-    args = parser.parse_args()
+    return parser
 
-    logging_level = logging.WARNING
-    if args.verbose > 0:
-        logging_level = logging.INFO
-        if args.verbose > 1:
-            logging_level = logging.DEBUG
 
-    logging.basicConfig(stream=sys.stdout, level=logging_level)
+async def async_main():
+    # a plain version query needs no parser
+    if sys.argv[1:] == ["--version"]:
+        print(__version__)
+        return
 
-    if "generate" in args or "generate_compat" in args:
-        letters = string.ascii_letters + string.digits
+    args = build_parser().parse_args()
+
+    # once is info, twice or more is debug
+    logging_level = (logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)]
 
+    # same as basicConfig but without checking for existing handlers
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging_level)
+
+    if "generate" in args or "generate_compat" in args:
         registration = {
             "id": "heisenbridge",
             "url": "http://{}:{}".format(args.listen_address or "127.0.0.1", args.listen_port or 9898),
-            "as_token": "".join(random.choice(letters) for i in range(64)),
-            "hs_token": "".join(random.choice(letters) for i in range(64)),
+            "as_token": secrets.token_urlsafe(48),
+            "hs_token": secrets.token_urlsafe(48),
             "rate_limited": False,
             "sender_localpart": "heisenbridge",
             "namespaces": {
@@ -968,15 +1196,18 @@ async def async_main():
         if "generate_compat" in args:
             registration["namespaces"]["users"].append({"regex": "@heisenbridge:.*", "exclusive": True})
 
-        if os.path.isfile(args.config):
-            print("Registration file already exists, not overwriting.")
-            sys.exit(1)
-
         if args.config == "-":
-            yaml.dump(registration, sys.stdout)
+            registration_yaml.dump(registration, sys.stdout)
         else:
-            with open(args.config, "w") as f:
-                yaml.dump(registration, f)
+            # create atomically and only readable by us, the file contains tokens
+            try:
+                fd = os.open(args.config, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+            except FileExistsError:
+                print("Registration file already exists, not overwriting.")
+                sys.exit(1)
+
+            with os.fdopen(fd, "w") as f:
+                registration_yaml.dump(registration, f)
 
             print(f"Registration file generated and saved to {args.config}")
     elif "reset" in args:
@@ -994,27 +1225,39 @@ async def async_main():
             identd = Identd()
             await identd.start_listening(service, args.identd_port)
 
-        if os.getuid() == 0:
-            if args.gid:
-                gid = grp.getgrnam(args.gid).gr_gid
-                os.setgid(gid)
+        if os.getuid() == 0 and (args.uid or args.gid):
+            pw = pwd.getpwnam(args.uid) if args.uid else None
+            gid = grp.getgrnam(args.gid).gr_gid if args.gid else pw.pw_gid
+
+            # never keep the supplementary groups of root
+            if pw:
+                os.initgroups(pw.pw_name, gid)
+            else:
                 os.setgroups([])
 
-            if args.uid:
-                uid = pwd.getpwnam(args.uid).pw_uid
-                os.setuid(uid)
+            os.setresgid(gid, gid, gid)
+
+            if pw:
+                os.setresuid(pw.pw_uid, pw.pw_uid, pw.pw_uid)
 
         os.umask(0o077)
 
         listen_address = args.listen_address
         listen_port = args.listen_port
 
+        # both defaults come from the same registration url
+        url = None
+        if not listen_address or not listen_port:
+            try:
+                url = urllib.parse.urlparse(service.registration["url"])
+            except Exception:
+                pass
+
         if not listen_address:
             listen_address = "127.0.0.1"
 
             try:
-                url = urllib.parse.urlparse(service.registration["url"])
-                if url.hostname:
+                if url and url.hostname:
                     listen_address = url.hostname
             except Exception:
                 pass
@@ -1023,8 +1266,7 @@ async def async_main():
             listen_port = 9898
 
             try:
-                url = urllib.parse.urlparse(service.registration["url"])
-                if url.port:
+                if url and url.port:
                     listen_port = url.port
             except Exception:
                 pass
@@ -1033,11 +1275,14 @@ async def async_main():
 
 
 def main():
-    asyncio.run(async_main())
-
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-if __name__ == "__main__":
     try:
-        main()
+        asyncio.run(async_main())
     except KeyboardInterrupt:
         pass
+
+
+if __name__ == "__main__":
+    main()
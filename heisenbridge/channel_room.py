@@ -93,7 +93,7 @@ class ChannelRoom(PrivateRoom):
         self.commands.register(cmd, self.cmd_names)
 
         # plumbs have a slightly adjusted version
-        if type(self) == ChannelRoom:
+        if type(self) is ChannelRoom:
             cmd = CommandParser(prog="TOPIC", description="show or set channel topic")
             cmd.add_argument("text", nargs="*", help="topic text if setting")
             self.commands.register(cmd, self.cmd_topic)
@@ -323,9 +323,13 @@ class ChannelRoom(PrivateRoom):
         self.names_buffer.extend(event.arguments[2].split())
 
     def _add_puppet(self, nick):
-        irc_user_id = self.serv.irc_user_id(self.network.name, nick)
+        irc_user_id = self.serv.try_irc_user_id(self.network.name, nick)
+
+        # only queue puppet registration if it isn't fully cached yet
+        if irc_user_id is None:
+            irc_user_id = self.serv.irc_user_id(self.network.name, nick)
+            self.ensure_irc_user_id(self.network.name, nick)
 
-        self.ensure_irc_user_id(self.network.name, nick)
         self.join(irc_user_id, nick)
 
     def _remove_puppet(self, user_id, reason=None):
@@ -335,10 +339,10 @@ class ChannelRoom(PrivateRoom):
         self.leave(user_id, reason)
 
     def on_endofnames(self, conn, event) -> None:
-        to_remove = []
+        to_remove = set()
         to_add = []
-        names = list(self.names_buffer)
-        self.names_buffer = []
+        # take over the buffer instead of copying it
+        names, self.names_buffer = self.names_buffer, []
         modes: Dict[str, List[str]] = {}
         others = []
         on_channel = []
@@ -346,12 +350,10 @@ class ChannelRoom(PrivateRoom):
         # always reset lazy list because it can be toggled on-the-fly
         self.lazy_members = {} if self.member_sync != "off" else None
 
-        # build to_remove list from our own puppets
+        # build to_remove set from our own puppets, anyone seen in names is discarded from it
         for member in self.members:
-            (name, server) = member.split(":", 1)
-
-            if name.startswith("@" + self.serv.puppet_prefix) and server == self.serv.server_name:
-                to_remove.append(member)
+            if self.serv.is_puppet(member):
+                to_remove.add(member)
 
         for nick in names:
             nick, mode = self.serv.strip_nick(nick)
@@ -376,7 +378,7 @@ class ChannelRoom(PrivateRoom):
 
             # make sure this user is not removed from room
             if irc_user_id in to_remove:
-                to_remove.remove(irc_user_id)
+                to_remove.discard(irc_user_id)
                 continue
 
             # ignore adding us here, only lazy join on echo allowed
@@ -392,10 +394,7 @@ class ChannelRoom(PrivateRoom):
                 self.lazy_members[irc_user_id] = nick
 
         # never remove us or appservice
-        if self.serv.user_id in to_remove:
-            to_remove.remove(self.serv.user_id)
-        if self.user_id in to_remove:
-            to_remove.remove(self.user_id)
+        to_remove -= {self.serv.user_id, self.user_id}
 
         self.send_notice(
             "Synchronizing members:"
@@ -33,5 +33,5 @@ class HiddenRoom(Room):
 
     async def post_init(self) -> None:
         # Those can be huge lists, but are entirely unused. Free up some memory.
-        self.members = []
+        self.members = set()
         self.displaynames = {}
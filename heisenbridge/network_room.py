@@ -7,6 +7,7 @@ import html
 import logging
 import re
 import ssl
+import sys
 import tempfile
 from argparse import Namespace
 from base64 import b32encode
@@ -529,7 +530,7 @@ class NetworkRoom(Room):
 
     def from_config(self, config: dict):
         if "name" in config:
-            self.name = config["name"]
+            self.name = sys.intern(config["name"])
         else:
             raise Exception("No name key in config for NetworkRoom")
 
@@ -818,7 +819,7 @@ class NetworkRoom(Room):
     async def cmd_unplumb(self, args) -> None:
         channel = args.channel.lower()
 
-        if channel not in self.rooms or type(self.rooms[channel]) != PlumbedRoom:
+        if channel not in self.rooms or type(self.rooms[channel]) is not PlumbedRoom:
             self.send_notice(f"{args.channel} is not plumbed")
             return
 
@@ -1120,11 +1121,11 @@ class NetworkRoom(Room):
         plumbs = []
 
         for room in self.rooms.values():
-            if type(room) == PrivateRoom:
+            if type(room) is PrivateRoom:
                 pms.append(room.name)
-            elif type(room) == ChannelRoom:
+            elif type(room) is ChannelRoom:
                 chans.append(room.name)
-            elif type(room) == PlumbedRoom:
+            elif type(room) is PlumbedRoom:
                 plumbs.append(room.name)
 
         if len(chans) > 0:
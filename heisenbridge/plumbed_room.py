@@ -202,14 +202,14 @@ class PlumbedRoom(ChannelRoom):
     @connected
     async def on_mx_message(self, event) -> None:
         sender = str(event.sender)
-        (name, server) = sender.split(":", 1)
+        (name, _, server) = sender.partition(":")
 
         # ignore self messages
         if sender == self.serv.user_id:
             return
 
         # prevent re-sending federated messages back
-        if name.startswith("@" + self.serv.puppet_prefix) and server == self.serv.server_name:
+        if self.serv.is_puppet(sender):
             return
 
         # add ZWSP to sender to avoid pinging on IRC
@@ -386,7 +386,7 @@ class PrivateRoom(Room):
 
         self.commands = CommandManager()
 
-        if type(self) == PrivateRoom:
+        if type(self) is PrivateRoom:
             cmd = CommandParser(prog="WHOIS", description="WHOIS the other user")
             self.commands.register(cmd, self.cmd_whois)
 
@@ -574,7 +574,7 @@ class PrivateRoom(Room):
 
         # assuming displayname of a puppet matches nick
         for member in self.members:
-            if not member.startswith("@" + self.serv.puppet_prefix) or not member.endswith(":" + self.serv.server_name):
+            if not self.serv.is_puppet(member):
                 continue
 
             if member in self.displaynames:
@@ -607,11 +607,11 @@ class PrivateRoom(Room):
                 return
             elif source_irc_user_id not in self.lazy_members:
                 # if we are a PM room, remove all other IRC users than the target
-                if type(self) == PrivateRoom:
+                if type(self) is PrivateRoom:
                     target_irc_user_id = self.serv.irc_user_id(self.network.name, self.name)
 
                     for user_id in self.members:
-                        if user_id.startswith("@" + self.serv.puppet_prefix) and user_id != target_irc_user_id:
+                        if self.serv.is_puppet(user_id) and user_id != target_irc_user_id:
                             if user_id in self.lazy_members:
                                 del self.lazy_members[user_id]
                             self.leave(user_id)
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import re
 from abc import ABC
@@ -6,6 +7,7 @@ from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Set
 
 from mautrix.appservice import AppService as MauService
 from mautrix.types import Membership
@@ -25,13 +27,15 @@ class Room(ABC):
     id: str
     user_id: str
     serv: AppService
-    members: List[str]
+    members: Set[str]
     lazy_members: Optional[Dict[str, str]]
     hidden_room_id: Optional[str]
     bans: List[str]
     displaynames: Dict[str, str]
     parser: IRCMatrixParser
 
+    lock: asyncio.Lock
+
     _mx_handlers: Dict[str, List[Callable[[dict], bool]]]
     _queue: EventQueue
 
@@ -39,7 +43,7 @@ class Room(ABC):
         self.id = id
         self.user_id = user_id
         self.serv = serv
-        self.members = list(members)
+        self.members = set(members)
         self.bans = list(bans) if bans else []
         self.lazy_members = None
         self.hidden_room_id = None
@@ -47,6 +51,9 @@ class Room(ABC):
         self.last_messages = defaultdict(str)
         self.parser = IRCMatrixParser(self.displaynames)
 
+        # serializes Matrix membership event handling for this room
+        self.lock = asyncio.Lock()
+
         self._mx_handlers = {}
         self._queue = EventQueue(self._flush_events)
 
@@ -141,8 +148,7 @@ class Room(ABC):
             await self.on_mx_ban(event.state_key)
 
         if event.content.membership == Membership.JOIN:
-            if event.state_key not in self.members:
-                self.members.append(event.state_key)
+            self.members.add(event.state_key)
 
             if event.content.displayname is not None:
                 self.displaynames[event.state_key] = str(event.content.displayname)
@@ -155,11 +161,14 @@ class Room(ABC):
 
         await self.az.intent.user(user_id).ensure_joined(self.id, ignore_cache=True)
 
-        self.members.append(user_id)
+        self.members.add(user_id)
         if nick is not None:
             self.displaynames[user_id] = nick
 
     async def _flush_events(self, events):
+        # puppets already ensured during this flush
+        ensured = set()
+
         for event in events:
             try:
                 if event["type"] == "_join":
@@ -180,8 +189,7 @@ class Room(ABC):
                             )
                         else:
                             await self.az.intent.user(event["user_id"]).leave_room(self.id)
-                        if event["user_id"] in self.members:
-                            self.members.remove(event["user_id"])
+                        self.members.discard(event["user_id"])
                         if event["user_id"] in self.displaynames:
                             del self.displaynames[event["user_id"]]
                 elif event["type"] == "_rename":
@@ -230,7 +238,13 @@ class Room(ABC):
                         if event["user_id"] in self.displaynames:
                             del self.displaynames[event["user_id"]]
                 elif event["type"] == "_ensure_irc_user_id":
-                    await self.serv.ensure_irc_user_id(event["network"], event["nick"])
+                    if (event["network"], event["nick"]) in ensured:
+                        continue
+
+                    if self.serv.try_irc_user_id(event["network"], event["nick"]) is None:
+                        await self.serv.ensure_irc_user_id(event["network"], event["nick"])
+
+                    ensured.add((event["network"], event["nick"]))
                 elif "state_key" in event:
                     intent = self.az.intent
 
@@ -5,6 +5,12 @@ import logging
 import aiohttp
 from mautrix.types.event import Event
 
+try:
+    # transactions can be large, prefer a faster JSON decoder when installed
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 class AppserviceWebsocket:
     def __init__(self, url, token, callback):
@@ -18,6 +24,21 @@ class AppserviceWebsocket:
     async def start(self):
         asyncio.create_task(self._loop())
 
+    async def _dispatch(self, events):
+        # events for different rooms are independent, only keep them ordered per room
+        rooms = {}
+        for event in events:
+            rooms.setdefault(event.get("room_id"), []).append(event)
+
+        await asyncio.gather(*[self._dispatch_room(room_events) for room_events in rooms.values()])
+
+    async def _dispatch_room(self, events):
+        for event in events:
+            try:
+                await self.callback(Event.deserialize(event))
+            except Exception as e:
+                logging.error(e)
+
     async def _loop(self):
         while True:
             try:
@@ -32,14 +53,10 @@ class AppserviceWebsocket:
                                 logging.debug("Unhandled WS message: %s", msg)
                                 continue
 
-                            data = msg.json()
+                            data = msg.json(loads=json_loads)
                             if data["status"] == "ok" and data["command"] == "transaction":
                                 logging.debug(f"Websocket transaction {data['txn_id']}")
-                                for event in data["events"]:
-                                    try:
-                                        await self.callback(Event.deserialize(event))
-                                    except Exception as e:
-                                        logging.error(e)
+                                await self._dispatch(data["events"])
 
                                 await ws.send_str(
                                     json.dumps(
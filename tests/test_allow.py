@@ -0,0 +1,47 @@
+from heisenbridge.__main__ import BridgeAppService
+
+
+def service(allow):
+    serv = BridgeAppService()
+    serv.config = {"owner": "@owner:example.com", "allow": allow}
+    serv._compile_allow()
+    return serv
+
+
+def test_allow():
+    serv = service(
+        {
+            "@admin*:example.com": "admin",
+            "*:example.org": "user",
+            "@boss:example.net": "admin",
+            "@user:example.net": "user",
+        }
+    )
+
+    assert serv.is_admin("@owner:example.com")
+    assert serv.is_user("@owner:example.com")
+
+    assert serv.is_admin("@admin1:example.com")
+    assert serv.is_user("@admin1:example.com")
+
+    assert not serv.is_admin("@foo:example.org")
+    assert serv.is_user("@foo:example.org")
+
+    assert not serv.is_admin("@foo:example.com")
+    assert not serv.is_user("@foo:example.com")
+    assert not serv.is_user("@foo:example.org.evil")
+
+    assert serv.is_admin("@boss:example.net")
+    assert serv.is_user("@boss:example.net")
+
+    assert not serv.is_admin("@user:example.net")
+    assert serv.is_user("@user:example.net")
+    assert not serv.is_user("@user2:example.net")
+
+
+def test_allow_empty():
+    serv = service({})
+
+    assert serv.is_admin("@owner:example.com")
+    assert not serv.is_admin("@foo:example.com")
+    assert not serv.is_user("@foo:example.com")
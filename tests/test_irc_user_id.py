@@ -0,0 +1,78 @@
+from heisenbridge.__main__ import BridgeAppService
+
+
+def service():
+    serv = BridgeAppService()
+    serv.puppet_separator = "_"
+    serv._set_namespace("example.com", "irc_")
+    serv._irc_user_ids = {}
+    return serv
+
+
+def test_irc_user_id():
+    serv = service()
+
+    assert serv.irc_user_id("libera", "foo") == "@irc_libera_foo:example.com"
+    assert serv.irc_user_id("Libera", "Foo") == "@irc_libera_foo:example.com"
+    assert serv.irc_user_id("libera", "@foo") == "@irc_libera_foo:example.com"
+    assert serv.irc_user_id("libera", "+foo") == "@irc_libera_foo:example.com"
+    assert serv.irc_user_id("libera", "foo", at=False) == "irc_libera_foo:example.com"
+    assert serv.irc_user_id("libera", "foo", server=False) == "@irc_libera_foo"
+    assert serv.irc_user_id("libera", "foo", at=False, server=False) == "irc_libera_foo"
+
+    # escaping
+    assert serv.irc_user_id("libera", "[foo]") == "@irc_libera_=5bfoo=5d:example.com"
+    assert serv.irc_user_id("libera", "föö") == "@irc_libera_f=c3b6=c3b6:example.com"
+    assert serv.irc_user_id("my net", "foo|bar") == "@irc_my=20net_foo=7cbar:example.com"
+
+    # cached results must not leak between forms
+    assert serv.irc_user_id("libera", "foo") == "@irc_libera_foo:example.com"
+
+
+def test_strip_nick():
+    serv = service()
+
+    assert serv.strip_nick("foo") == ("foo", None)
+    assert serv.strip_nick("@foo") == ("foo", "@")
+    assert serv.strip_nick("+foo") == ("foo", "+")
+    assert serv.strip_nick("~foo") == ("foo", "~")
+    assert serv.strip_nick("@") == ("@", None)
+    assert serv.strip_nick("[foo]") == ("[foo]", None)
+
+
+def test_split_irc_user_id():
+    serv = service()
+
+    assert serv.split_irc_user_id("@irc_libera_foo:example.com") == ("libera", "foo")
+    assert serv.split_irc_user_id("@irc_libera_foo_bar:example.com") == ("libera", "foo_bar")
+    assert serv.split_irc_user_id("@irc_my=20net_foo=7cbar:example.com") == ("my net", "foo|bar")
+    assert serv.split_irc_user_id("@irc_libera:example.com") == (None, None)
+    assert serv.split_irc_user_id("@irc_libera_foo:example.org") == (None, None)
+    assert serv.split_irc_user_id("@irc_libera_foo:example.com:8448") == (None, None)
+    assert serv.split_irc_user_id("@foo:example.com") == (None, None)
+
+
+def test_nick_from_irc_user_id():
+    serv = service()
+
+    assert serv.nick_from_irc_user_id("libera", "@irc_libera_foo:example.com") == "foo"
+    assert serv.nick_from_irc_user_id("libera", "@irc_libera_=5bfoo=5d:example.com") == "[foo]"
+    assert serv.nick_from_irc_user_id("my net", "@irc_my=20net_foo:example.com") == "foo"
+    assert serv.nick_from_irc_user_id("oftc", "@irc_libera_foo:example.com") is None
+    assert serv.nick_from_irc_user_id("libera", "@irc_libera_foo:example.org") is None
+
+
+def test_is_local():
+    serv = service()
+
+    assert serv.is_local("@foo:example.com")
+    assert not serv.is_local("@foo:example.org")
+    assert not serv.is_local("@foo:notexample.com")
+
+
+def test_is_puppet():
+    serv = service()
+
+    assert serv.is_puppet("@irc_libera_foo:example.com")
+    assert not serv.is_puppet("@irc_libera_foo:example.org")
+    assert not serv.is_puppet("@foo:example.com")
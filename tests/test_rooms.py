@@ -0,0 +1,115 @@
+import asyncio
+
+from heisenbridge.__main__ import BridgeAppService
+from heisenbridge.control_room import ControlRoom
+from heisenbridge.hidden_room import HiddenRoom
+from heisenbridge.network_room import NetworkRoom
+from heisenbridge.private_room import PrivateRoom
+
+
+def service():
+    serv = BridgeAppService()
+    serv.config = {"owner": "@a:example.com", "allow": {}}
+    serv._compile_allow()
+    serv._rooms = {}
+    serv._rooms_by_type = {}
+    serv._rooms_by_user = {}
+    serv._network_rooms = {}
+    return serv
+
+
+def room(cls, serv, id, user_id, name=None):
+    ret = cls(id=id, user_id=user_id, serv=serv, members=[], bans=[])
+    if name is not None:
+        ret.name = name
+    return ret
+
+
+def ids(rooms):
+    return sorted(room.id for room in rooms)
+
+
+def test_rooms():
+    # rooms start their event queue on creation and need a running loop
+    asyncio.run(_test_rooms())
+
+
+async def _test_rooms():
+    serv = service()
+
+    hidden = room(HiddenRoom, serv, "!hidden", None)
+    control_a = room(ControlRoom, serv, "!control_a", "@a:example.com")
+    control_b = room(ControlRoom, serv, "!control_b", "@b:example.com")
+    libera_a = room(NetworkRoom, serv, "!libera_a", "@a:example.com", "Libera")
+    oftc_a = room(NetworkRoom, serv, "!oftc_a", "@a:example.com", "OFTC")
+    libera_b = room(NetworkRoom, serv, "!libera_b", "@b:example.com", "libera")
+    private_a = room(PrivateRoom, serv, "!private_a", "@a:example.com")
+
+    for r in (hidden, control_a, control_b, libera_a, oftc_a, libera_b, private_a):
+        serv.register_room(r)
+
+    # no filters
+    assert ids(serv.find_rooms()) == [
+        "!control_a",
+        "!control_b",
+        "!hidden",
+        "!libera_a",
+        "!libera_b",
+        "!oftc_a",
+        "!private_a",
+    ]
+
+    # type only, by class or by name
+    assert ids(serv.find_rooms(NetworkRoom)) == ["!libera_a", "!libera_b", "!oftc_a"]
+    assert ids(serv.find_rooms("ControlRoom")) == ["!control_a", "!control_b"]
+    assert ids(serv.find_rooms(HiddenRoom)) == ["!hidden"]
+
+    # user only
+    assert ids(serv.find_rooms(user_id="@a:example.com")) == ["!control_a", "!libera_a", "!oftc_a", "!private_a"]
+    assert ids(serv.find_rooms(user_id="@c:example.com")) == []
+
+    # type and user
+    assert ids(serv.find_rooms(NetworkRoom, "@b:example.com")) == ["!libera_b"]
+    assert ids(serv.find_rooms(PrivateRoom, "@b:example.com")) == []
+    assert ids(serv.find_rooms("SpaceRoom", "@a:example.com")) == []
+
+    # network rooms are indexed by owner and lowercased name
+    assert list(serv._network_rooms[("@a:example.com", "libera")].values()) == [libera_a]
+    assert list(serv._network_rooms[("@b:example.com", "libera")].values()) == [libera_b]
+    assert ("@b:example.com", "oftc") not in serv._network_rooms
+
+    # re-registering the same id replaces the previous instance everywhere
+    control_a2 = room(ControlRoom, serv, "!control_a", "@a:example.com")
+    serv.register_room(control_a2)
+    assert serv._rooms["!control_a"] is control_a2
+    assert serv.find_rooms(ControlRoom, "@a:example.com") == [control_a2]
+    assert len(serv.find_rooms(user_id="@a:example.com")) == 4
+
+    # unknown ids are ignored
+    serv.unregister_room("!unknown")
+    assert len(serv.find_rooms()) == 7
+
+    # emptied inner indexes are removed
+    serv.unregister_room("!libera_b")
+    assert ("@b:example.com", "libera") not in serv._network_rooms
+    assert "@b:example.com" not in serv._rooms_by_type["NetworkRoom"]
+    assert ids(serv.find_rooms(user_id="@b:example.com")) == ["!control_b"]
+
+    serv.unregister_room("!control_b")
+    assert "@b:example.com" not in serv._rooms_by_user
+
+    serv.unregister_room("!private_a")
+    assert "PrivateRoom" not in serv._rooms_by_type
+
+    serv.unregister_room("!hidden")
+    assert None not in serv._rooms_by_user
+    assert "HiddenRoom" not in serv._rooms_by_type
+    assert serv.find_rooms(HiddenRoom) == []
+
+    serv.unregister_room("!libera_a")
+    serv.unregister_room("!oftc_a")
+    serv.unregister_room("!control_a")
+    assert serv._rooms == {}
+    assert serv._rooms_by_type == {}
+    assert serv._rooms_by_user == {}
+    assert serv._network_rooms == {}